@@ -1,11 +1,17 @@
-from fastapi import FastAPI, Query, UploadFile, File
+from fastapi import FastAPI, Query, UploadFile, File, Response
 from typing import Optional
+from contextlib import asynccontextmanager, contextmanager
+import asyncio
 import os
 import logging
+import queue
+import shutil
 import tempfile
+import traceback
 import snowflake.connector
 from dotenv import load_dotenv
 from ingestion.ingest_trips import main as enrich_and_save_to_snowflake
+from ingestion.ingest_trips import refresh_weekly_summary
 
 # ------------------------------------------------------------
 # 1. Initial setup
@@ -18,11 +24,13 @@ logging.basicConfig(
 # Load environment variables from .env (Snowflake credentials, etc.)
 load_dotenv()
 
-app = FastAPI()
+# Idle Snowflake connections kept open between requests
+POOL_SIZE = int(os.getenv("SNOWFLAKE_POOL_SIZE", "8"))
+CONNECTION_POOL = queue.Queue(maxsize=POOL_SIZE)
 
 
 # ------------------------------------------------------------
-# 2. get_connection: create and return a Snowflake connection
+# 2. get_connection / pooled_connection: Snowflake connections
 # ------------------------------------------------------------
 def get_connection():
     """
@@ -36,11 +44,88 @@ def get_connection():
         warehouse=os.getenv("SNOWFLAKE_WAREHOUSE"),
         database=os.getenv("SNOWFLAKE_DATABASE"),
         schema=os.getenv("SNOWFLAKE_SCHEMA", "PUBLIC"),
+        # keep pooled sessions authenticated while idle (heartbeat every 15 min)
+        client_session_keep_alive=True,
+        client_session_keep_alive_heartbeat_frequency=900,
+    )
+
+
+@contextmanager
+def pooled_connection():
+    """
+    Borrow a connection from CONNECTION_POOL, opening a new one only when
+    the pool is empty, and give it back afterwards so the next request
+    skips the login round-trip. Connections that are closed, or whose
+    block raised, are discarded.
+    """
+    try:
+        conn = CONNECTION_POOL.get_nowait()
+    except queue.Empty:
+        conn = get_connection()
+
+    try:
+        yield conn
+    except Exception:
+        # the session may be expired or the socket dropped: never reuse it
+        conn.close()
+        raise
+
+    if not conn.is_closed():
+        try:
+            CONNECTION_POOL.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+
+def ensure_weekly_summary():
+    """
+    Create TRIPS_WEEKLY_BY_REGION (read by mode=region) if it is missing,
+    e.g. when TRIPS was loaded before the ingestion pipeline maintained it.
+    """
+    try:
+        with pooled_connection() as conn, conn.cursor() as cs:
+            refresh_weekly_summary(cs, replace=False)
+    except Exception as e:
+        logging.error(f"Could not ensure TRIPS_WEEKLY_BY_REGION: {e}")
+
+
+def close_pool():
+    """
+    Close every idle pooled connection when the API stops.
+    """
+    while not CONNECTION_POOL.empty():
+        CONNECTION_POOL.get_nowait().close()
+
+
+@asynccontextmanager
+async def lifespan(app):
+    """
+    Startup: make sure the weekly summary exists. Shutdown: close the pool.
+    """
+    await asyncio.to_thread(ensure_weekly_summary)
+    yield
+    close_pool()
+
+
+app = FastAPI(lifespan=lifespan)
+
+
+# ------------------------------------------------------------
+# 3. to_json_response: return a DataFrame as a JSON response
+# ------------------------------------------------------------
+def to_json_response(df):
+    """
+    Serialize a query result DataFrame as a JSON list of records using
+    pandas' C JSON writer (timestamps in ISO format, second precision).
+    """
+    return Response(
+        content=df.to_json(orient="records", date_format="iso", date_unit="s"),
+        media_type="application/json",
     )
 
 
 # ------------------------------------------------------------
-# 3. GET /weekly_average: compute average daily trips per week
+# 4. GET /weekly_average: compute average daily trips per week
 # ------------------------------------------------------------
 @app.get("/weekly_average")
 def weekly_average(
@@ -62,74 +147,77 @@ def weekly_average(
         f"lon_min={lon_min}, lon_max={lon_max}"
     )
 
-    conn = get_connection()
-    cs = conn.cursor()
-
+    # Errors are turned into responses outside pooled_connection so a failed
+    # connection is discarded instead of returned to the pool
     try:
-        if mode == "region":
-            if not region:
-                logging.warning("GET /weekly_average called without 'region' parameter")
-                return {"error": "region parameter is required when mode=region"}
-
-            sql = """
-                SELECT
-                  region,
-                  DATE_TRUNC('week', departure_time) AS week,
-                  COUNT(*) / 7 AS avg_trips_per_day
-                FROM trips
-                WHERE region = %s
-                GROUP BY region, week
-                ORDER BY week;
-            """
-            cs.execute(sql, (region,))
-            rows = cs.fetchall()
-            columns = [desc[0] for desc in cs.description]
-            data = [dict(zip(columns, row)) for row in rows]
-            logging.info(
-                f"GET /weekly_average by region '{region}' returned {len(data)} rows."
-            )
-            return data
-
-        elif mode == "bbox":
-            if None in (lat_min, lat_max, lon_min, lon_max):
-                logging.warning("GET /weekly_average called without complete bbox parameters")
-                return {
-                    "error": "lat_min, lat_max, lon_min, lon_max are required when mode=bbox"
-                }
-
-            sql = """
-                SELECT
-                  DATE_TRUNC('week', departure_time) AS week,
-                  COUNT(*) / 7 AS avg_trips_per_day
-                FROM trips
-                WHERE origin_latitude  BETWEEN %s AND %s
-                  AND origin_longitude BETWEEN %s AND %s
-                GROUP BY week
-                ORDER BY week;
-            """
-            cs.execute(sql, (lat_min, lat_max, lon_min, lon_max))
-            rows = cs.fetchall()
-            columns = [desc[0] for desc in cs.description]
-            data = [dict(zip(columns, row)) for row in rows]
-            logging.info(f"GET /weekly_average for bbox returned {len(data)} rows.")
-            return data
-
-        else:
-            logging.error("GET /weekly_average called with invalid mode")
-            return {"error": "Invalid mode"}
+        with pooled_connection() as conn, conn.cursor() as cs:
+            if mode == "region":
+                if not region:
+                    logging.warning("GET /weekly_average called without 'region' parameter")
+                    return {"error": "region parameter is required when mode=region"}
+
+                # Pre-aggregated by the ingestion pipeline after every load
+                sql = """
+                    SELECT
+                      region,
+                      week,
+                      avg_trips_per_day
+                    FROM trips_weekly_by_region
+                    WHERE region = %s
+                    ORDER BY week;
+                """
+                cs.execute(sql, (region,))
+                # Arrow result batches -> DataFrame -> JSON, without per-row Python dicts
+                df = cs.fetch_pandas_all()
+                logging.info(
+                    f"GET /weekly_average by region '{region}' returned {len(df)} rows."
+                )
+                return to_json_response(df)
+
+            elif mode == "bbox":
+                if None in (lat_min, lat_max, lon_min, lon_max):
+                    logging.warning("GET /weekly_average called without complete bbox parameters")
+                    return {
+                        "error": "lat_min, lat_max, lon_min, lon_max are required when mode=bbox"
+                    }
+
+                sql = """
+                    SELECT
+                      DATE_TRUNC('week', departure_time) AS week,
+                      COUNT(*) / 7 AS avg_trips_per_day
+                    FROM trips
+                    WHERE origin_latitude  BETWEEN %s AND %s
+                      AND origin_longitude BETWEEN %s AND %s
+                    GROUP BY week
+                    ORDER BY week;
+                """
+                cs.execute(sql, (lat_min, lat_max, lon_min, lon_max))
+                df = cs.fetch_pandas_all()
+                logging.info(f"GET /weekly_average for bbox returned {len(df)} rows.")
+                return to_json_response(df)
+
+            else:
+                logging.error("GET /weekly_average called with invalid mode")
+                return {"error": "Invalid mode"}
 
     except Exception as e:
         logging.error(f"Error querying /weekly_average: {e}")
         return {"error": str(e)}
 
-    finally:
-        cs.close()
-        conn.close()
-
 
 # ------------------------------------------------------------
-# 4. POST /ingest: accept CSV upload and ingest into Snowflake
+# 5. POST /ingest: accept CSV upload and ingest into Snowflake
 # ------------------------------------------------------------
+def save_upload(src):
+    """
+    Copy an uploaded file object to a new temporary .csv file in 1 MB blocks.
+    Returns the temporary file path.
+    """
+    with tempfile.NamedTemporaryFile(delete=False, suffix=".csv") as tmp:
+        shutil.copyfileobj(src, tmp, 1 << 20)
+        return tmp.name
+
+
 @app.post("/ingest")
 async def ingest_csv(file: UploadFile = File(...)):
     """
@@ -137,19 +225,16 @@ async def ingest_csv(file: UploadFile = File(...)):
     and load pipeline into Snowflake.
     Returns status and filename.
     """
-    import traceback
-
     logging.info(f"Received POST /ingest for file: {file.filename}")
 
-    # Save upload to a temporary file
-    with tempfile.NamedTemporaryFile(delete=False, suffix=".csv") as tmp:
-        contents = await file.read()
-        tmp.write(contents)
-        tmp_path = tmp.name
+    # Stream upload to a temporary file in 1 MB blocks instead of reading it all into memory;
+    # the whole copy runs in a worker thread so the event loop does no file I/O
+    tmp_path = await asyncio.to_thread(save_upload, file.file)
 
     try:
         logging.info(f"Starting ingestion for file {file.filename} via API")
-        enrich_and_save_to_snowflake(tmp_path)
+        # Run the blocking pipeline in a worker thread so the event loop keeps serving requests
+        await asyncio.to_thread(enrich_and_save_to_snowflake, tmp_path)
         logging.info(f"Completed ingestion for file {file.filename} successfully")
         return {"status": "success", "filename": file.filename}
 
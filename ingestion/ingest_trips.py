@@ -1,13 +1,20 @@
+import numpy as np
 import pandas as pd
 import reverse_geocoder as rg
-import re
+from scipy.spatial import cKDTree
 import os
 import logging
+import multiprocessing
+import threading
+from functools import lru_cache
 from dotenv import load_dotenv
 import snowflake.connector
-from snowflake.connector.pandas_tools import write_pandas
 import argparse
+import tempfile
 import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 
 # ------------------------------------------------------------
 # 1. Initial setup
@@ -20,99 +27,230 @@ logging.basicConfig(
 # Load environment variables from .env file (user, password, etc.)
 load_dotenv()
 
-GEO_CACHE = {}  # fora do loop
+
+@lru_cache(maxsize=None)
+def get_city_index():
+    """
+    Build (once per process, on first use) the reverse-geocoding index from
+    reverse_geocoder's bundled cities CSV: a cKDTree over the (lat, lon)
+    points plus parallel numpy arrays with the city name and country code
+    of each point (row i <-> tree point i).
+    """
+    cities = pd.read_csv(
+        os.path.join(os.path.dirname(rg.__file__), rg.RG_FILE),
+        usecols=["lat", "lon", "name", "cc"],
+        dtype={"lat": "float64", "lon": "float64", "name": "object", "cc": "object"},
+        keep_default_na=False,  # "NA" is Namibia's country code
+    )
+    tree = cKDTree(cities[["lat", "lon"]].to_numpy())
+    return tree, cities["name"].to_numpy(), cities["cc"].to_numpy()
+
+# Worker processes used to enrich chunks in parallel. Under the API every uvicorn
+# worker (WEB_CONCURRENCY) owns its own pool, so the CPUs are split between them.
+INGEST_WORKERS = int(os.getenv(
+    "INGEST_WORKERS",
+    max(1, (os.cpu_count() or 1) // int(os.getenv("WEB_CONCURRENCY", "1")))
+))
+# Threads per KD-tree query: all cores by default, 1 inside pool workers
+# (INGEST_WORKERS processes already use every core)
+KDTREE_WORKERS = -1
+
+# Process-wide enrichment pool, created on first use and reused across ingests
+_EXECUTOR = None
+_EXECUTOR_LOCK = threading.Lock()
+
+# Input CSV columns, named as in TRIPS. Headers are renamed/uppercased at read time,
+# so chunks come out of read_csv already in their final shape.
+CSV_RENAMES = {"datetime": "departure_time"}
+INPUT_COLS = ["REGION", "ORIGIN_COORD", "DESTINATION_COORD", "DEPARTURE_TIME", "DATASOURCE"]
+# low-cardinality text columns are parsed (and written to Parquet) dictionary-encoded
+INPUT_DTYPES = {"REGION": "category", "DATASOURCE": "category"}
+
+# TRIPS clustering key: origin coordinates bucketed to 0.1 degree, so the key has
+# low cardinality (cheap reclustering) while still pruning bbox range filters
+TRIPS_CLUSTER_KEY = "ROUND(ORIGIN_LATITUDE, 1), ROUND(ORIGIN_LONGITUDE, 1)"
+
+# WKT pattern "POINT(<lon> <lat>)"
+WKT_PATTERN = r'POINT\s*\(([-\d\.]+)\s+([-\d\.]+)\)'
 
 # ------------------------------------------------------------
-# 2. parse_point function: convert WKT or "lat,lon" string into (lat, lon) tuple
+# 2. parse_points function: convert WKT or "lat,lon" strings into latitude/longitude arrays
 # ------------------------------------------------------------
-def parse_point(coord_str):
+def parse_points(coords):
     """
-    Take a coordinate string and return (latitude, longitude).
-    Supports:
+    Parse a Series of coordinate strings. Supports:
       - WKT: "POINT(<lon> <lat>)"
       - CSV: "<lat>,<lon>"
-    Returns None if the string is empty or invalid.
+    Runs one regex sweep for the WKT rows and one split for the "lat,lon"
+    rows instead of a Python call per row.
+    Returns two float64 arrays (latitude, longitude), NaN where the string
+    is empty or invalid.
     """
-    if pd.isna(coord_str) or not coord_str:
-        return None
+    coords = coords.astype("string")
+    lat = np.full(len(coords), np.nan)
+    lon = np.full(len(coords), np.nan)
 
     # WKT case: extract lon and lat via regex
-    match = re.match(r'POINT\s*\(([-\d\.]+)\s+([-\d\.]+)\)', coord_str)
-    if match:
-        lon, lat = map(float, match.groups())
-        return lat, lon
+    wkt = coords.str.extract('^' + WKT_PATTERN)
+    is_wkt = wkt[0].notna().to_numpy()
+    lon[is_wkt] = wkt.loc[is_wkt, 0].astype(float).to_numpy()
+    lat[is_wkt] = wkt.loc[is_wkt, 1].astype(float).to_numpy()
 
     # "lat,lon" case
-    if ',' in coord_str:
-        lat, lon = map(float, coord_str.split(','))
-        return lat, lon
+    is_csv = ~is_wkt & coords.str.contains(',', regex=False, na=False).to_numpy()
+    if is_csv.any():
+        parts = coords[is_csv].str.split(',', n=1, expand=True).astype(float)
+        lat[is_csv] = parts[0].to_numpy()
+        lon[is_csv] = parts[1].to_numpy()
+
+    unknown = ~is_wkt & ~is_csv & coords.fillna('').str.len().gt(0).to_numpy()
+    for coord_str in coords[unknown]:
+        logging.warning("Unrecognized coordinate format: %s", coord_str)
 
-    logging.warning("Unrecognized coordinate format: %s", coord_str)
-    return None
+    return lat, lon
 
 
 # ------------------------------------------------------------
-# 3. enrich_batch function: enrich a DataFrame with city, country, and latitude/longitude
+# 3. enrich_all function: reverse-geocode every coordinate column in one pass
 # ------------------------------------------------------------
+def enrich_all(df, prefixes=("ORIGIN", "DESTINATION")):
+    """
+    Enrich every df[{prefix}_COORD] column in a single pass over their
+    concatenation (length len(prefixes) * N):
+      - parse all coordinates in one vectorized pass
+      - query the city index once for all valid points
+      - fill city/country by indexing the index's name and country arrays
+      - split the results back into {prefix}_CITY, COUNTRY, LATITUDE, LONGITUDE
+    """
+    combined = pd.concat([df[f"{prefix}_COORD"] for prefix in prefixes], ignore_index=True)
+
+    lats, lons = parse_points(combined)
+    valid = ~np.isnan(lats)
+
+    # one batched KD-tree query; rows with no valid point stay None
+    cities    = np.full(len(combined), None, dtype=object)
+    countries = np.full(len(combined), None, dtype=object)
+    if valid.any():
+        tree, city_names, city_ccs = get_city_index()
+        _, idx = tree.query(np.column_stack([lats[valid], lons[valid]]), k=1, workers=KDTREE_WORKERS)
+        cities[valid]    = city_names[idx]
+        countries[valid] = city_ccs[idx]
+
+    # assign whole columns; float32 avoids object-dtype boxing on upload and
+    # the few distinct country codes are stored dictionary-encoded
+    n = len(df)
+    for k, prefix in enumerate(prefixes):
+        part = slice(k * n, (k + 1) * n)
+        df[f"{prefix}_CITY"]      = cities[part]
+        df[f"{prefix}_COUNTRY"]   = pd.Categorical(countries[part])
+        df[f"{prefix}_LATITUDE"]  = lats[part].astype(np.float32)
+        df[f"{prefix}_LONGITUDE"] = lons[part].astype(np.float32)
+
+
+# ------------------------------------------------------------
+# 4. Enrichment process pool
+# ------------------------------------------------------------
+def init_worker():
+    """
+    Initializer of every pool worker: build the city index and keep KD-tree
+    queries single-threaded.
+    """
+    global KDTREE_WORKERS
+    KDTREE_WORKERS = 1
+    get_city_index()
+
+
+def get_executor():
+    """
+    Return the process-wide enrichment pool, creating it on first use.
+    Workers are started with "spawn" because the API calls main() from a
+    threaded process, where fork can deadlock; the pool is kept across
+    ingests so workers start (and load their data) only once.
+    """
+    global _EXECUTOR
+    with _EXECUTOR_LOCK:
+        if _EXECUTOR is None:
+            _EXECUTOR = ProcessPoolExecutor(
+                max_workers=INGEST_WORKERS,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=init_worker,
+            )
+        return _EXECUTOR
+
+
+def reset_executor():
+    """
+    Drop a pool whose worker died so the next ingest starts a fresh one.
+    """
+    global _EXECUTOR
+    with _EXECUTOR_LOCK:
+        if _EXECUTOR is not None:
+            _EXECUTOR.shutdown(wait=False, cancel_futures=True)
+            _EXECUTOR = None
+
+
 # ------------------------------------------------------------
-# 3. enrich_batch function with global caching
+# 5. enrich_chunk function: process-pool task for a single CSV chunk
 # ------------------------------------------------------------
-def enrich_batch(df, source_col, prefix):
+def enrich_chunk(chunk, i, out_dir):
     """
-    For each value in df[source_col]:
-      - parse into pt = (lat, lon)
-      - if pt in GEO_CACHE, reuse GEO_CACHE[pt]
-      - else call rg.search once and store in GEO_CACHE
-      - populate {prefix}_city, country, latitude, longitude
+    Runs in a worker process on a chunk already read with TRIPS column names:
+      a) Enrich ORIGIN_COORD and DESTINATION_COORD
+      b) Write it to out_dir/chunk_<i>.parquet (COPY matches columns by name,
+         so no reordering is needed)
+    Returns the Parquet file path.
     """
-    city_col    = f"{prefix}_city"
-    country_col = f"{prefix}_country"
-    lat_col     = f"{prefix}_latitude"
-    lon_col     = f"{prefix}_longitude"
+    logging.info("Processing chunk %d: %d rows", i, len(chunk))
 
-    # initialize empty columns
-    df[city_col]    = None
-    df[country_col] = None
-    df[lat_col]     = None
-    df[lon_col]     = None
+    # a) Enrich coordinates
+    t0 = time.perf_counter()
+    enrich_all(chunk)
+    logging.info("Chunk %d enrichment took %.1f s", i, time.perf_counter() - t0)
 
-    for idx, coord_str in enumerate(df[source_col]):
-        pt = parse_point(coord_str)
-        if not pt:
-            continue
+    # b) Write chunk as Parquet
+    path = os.path.join(out_dir, f"chunk_{i}.parquet")
+    chunk.to_parquet(path, compression="snappy", index=False)
+    return path
 
-        # use or populate global cache
-        if pt in GEO_CACHE:
-            res = GEO_CACHE[pt]
-        else:
-            # single-point batch, retorna lista com 1 item
-            res = rg.search([pt], mode=1)[0]
-            GEO_CACHE[pt] = res
 
-        # preenche
-        lat, lon = pt
-        df.at[idx, city_col]    = res['name']
-        df.at[idx, country_col] = res['cc']
-        df.at[idx, lat_col]     = lat
-        df.at[idx, lon_col]     = lon
+# ------------------------------------------------------------
+# 6. refresh_weekly_summary function: pre-aggregated weekly averages by region
+# ------------------------------------------------------------
+def refresh_weekly_summary(cs, replace=True):
+    """
+    Build TRIPS_WEEKLY_BY_REGION from TRIPS with the given cursor.
+    replace=True rebuilds it (after a load); replace=False only creates it
+    when missing (API startup on tables loaded before it existed).
+    """
+    ddl = "CREATE OR REPLACE TABLE" if replace else "CREATE TABLE IF NOT EXISTS"
+    cs.execute(f"""
+        {ddl} TRIPS_WEEKLY_BY_REGION AS
+        SELECT
+          region,
+          DATE_TRUNC('week', departure_time) AS week,
+          COUNT(*) / 7 AS avg_trips_per_day
+        FROM TRIPS
+        GROUP BY region, week
+    """)
+    logging.info("TRIPS_WEEKLY_BY_REGION %s", "refreshed" if replace else "ensured")
 
 
 # ------------------------------------------------------------
-# 4. main function: orchestrate reading, enrichment, and loading into Snowflake
+# 7. main function: orchestrate reading, enrichment, and loading into Snowflake
 # ------------------------------------------------------------
 def main(csv_file):
     """
     1) Connect to Snowflake using credentials in .env
-    2) Ensure the TRIPS table exists
-    3) Read the CSV in chunks (chunksize=100k)
-    4) For each chunk:
-         a) Rename 'datetime' to 'departure_time
-         b) Enrich origin_coord and destination_coord
-         c) Normalize column names to uppercase and reorder
-         d) Bulk-insert using write_pandas
-         e) Clear the internal stage
-    """
-    # 4.1 Connect to Snowflake
+    2) Ensure the TRIPS table exists, clustered by rounded origin coordinates
+    3) Read the CSV in chunks (chunksize=50k), renaming columns and setting
+       dtypes at read time
+    4) Enrich each chunk into a local Parquet file with enrich_chunk,
+       spread over INGEST_WORKERS processes
+    5) Upload all Parquet files to a temporary stage with a single PUT
+    6) Load every staged file with a single COPY INTO (PURGE clears the stage)
+    7) Rebuild the TRIPS_WEEKLY_BY_REGION summary table
+    """
+    # 7.1 Connect to Snowflake
     conn = snowflake.connector.connect(
         user=os.getenv("SNOWFLAKE_USER"),
         password=os.getenv("SNOWFLAKE_PASSWORD"),
@@ -123,7 +261,7 @@ def main(csv_file):
     )
     cs = conn.cursor()
 
-    # 4.2 Create the trips table if it doesn't already exist
+    # 7.2 Create the trips table if it doesn't already exist and set its clustering key
     cs.execute("""
         CREATE TABLE IF NOT EXISTS TRIPS(
             region                VARCHAR,
@@ -141,69 +279,84 @@ def main(csv_file):
             destination_longitude FLOAT
         )
     """)
+    # Cluster on ~11 km origin cells so bbox queries prune micro-partitions. Only
+    # ALTER when SHOW TABLES reports a different key (also covers older tables).
+    cs.execute("SHOW TABLES LIKE 'TRIPS'")
+    columns = [desc[0] for desc in cs.description]
+    cluster_by = dict(zip(columns, cs.fetchone() or ())).get("cluster_by") or ""
+    wanted = f"LINEAR({TRIPS_CLUSTER_KEY})".upper().replace(" ", "")
+    if cluster_by.upper().replace(" ", "") != wanted:
+        cs.execute(f"ALTER TABLE TRIPS CLUSTER BY ({TRIPS_CLUSTER_KEY})")
+        logging.info("TRIPS clustering key set to (%s)", TRIPS_CLUSTER_KEY)
+    # Session-scoped stage for the Parquet chunks; dropped automatically on close
+    cs.execute("CREATE TEMPORARY STAGE IF NOT EXISTS TRIPS_STG FILE_FORMAT = (TYPE = PARQUET)")
     cs.close()
 
-    # Fixed list of columns in the correct order for write_pandas
-    expected_cols = [
-        "REGION",
-        "ORIGIN_COORD",
-        "DESTINATION_COORD",
-        "DEPARTURE_TIME",
-        "DATASOURCE",
-        "ORIGIN_CITY",
-        "ORIGIN_COUNTRY",
-        "ORIGIN_LATITUDE",
-        "ORIGIN_LONGITUDE",
-        "DESTINATION_CITY",
-        "DESTINATION_COUNTRY",
-        "DESTINATION_LATITUDE",
-        "DESTINATION_LONGITUDE"
-    ]
-
-    # 4.3 Process file in chunks
-    reader = pd.read_csv(csv_file, chunksize=50_000)
-    for i, chunk in enumerate(reader, start=1):
-        logging.info("Processing chunk %d: %d rows", i, len(chunk))
-
-        # a) Rename datetime column
-        if 'datetime' in chunk.columns:
-            chunk.rename(columns={'datetime': 'departure_time'}, inplace=True)
-
-        # b) Enrich coordinates
-        t0 = time.perf_counter()
-        enrich_batch(chunk, "origin_coord", "origin")
-        enrich_batch(chunk, "destination_coord", "destination")
-        logging.info("Chunk %d enrichment took %.1f s", i, time.perf_counter() - t0)
-
-        # c) Uppercase column names, reorder e reset index
-        chunk.columns = chunk.columns.str.upper()
-        chunk = chunk.reindex(columns=expected_cols)
-        chunk.reset_index(drop=True, inplace=True)
-
-        # d) Bulk insert via write_pandas
-        success, nchunks, nrows, _ = write_pandas(
-            conn, chunk,
-            table_name='TRIPS',
-            chunk_size=25_000,
-            parallel=4
+    # 7.3 Enrich chunks in the shared process pool, writing every chunk to the same local directory.
+    #     At most 2 chunks per worker are in flight so the CSV is never fully in memory.
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        header = pd.read_csv(csv_file, nrows=0).columns
+        reader = pd.read_csv(
+            csv_file,
+            chunksize=50_000,
+            header=0,
+            names=[CSV_RENAMES.get(col, col).upper() for col in header],
+            usecols=lambda col: col in INPUT_COLS,
+            dtype=INPUT_DTYPES,
         )
-        if not success:
-            logging.error("Failed to insert chunk %d", i)
-        else:
-            logging.info("Chunk %d inserted: %d rows in %d operations", i, nrows, nchunks)
+        executor = get_executor()
+        pending = deque()
+        try:
+            for i, chunk in enumerate(reader, start=1):
+                pending.append(executor.submit(enrich_chunk, chunk, i, tmp_dir))
+                if len(pending) >= 2 * INGEST_WORKERS:
+                    pending.popleft().result()
+            while pending:
+                pending.popleft().result()
+        except BrokenProcessPool:
+            reset_executor()
+            raise
+        finally:
+            for future in pending:
+                future.cancel()
+
+        # 7.4 Upload all chunk files with one PUT; PARALLEL spreads them over threads
+        with conn.cursor() as cs:
+            cs.execute(
+                f"PUT 'file://{tmp_dir}/*.parquet' @TRIPS_STG "
+                "PARALLEL = 8 AUTO_COMPRESS = FALSE OVERWRITE = TRUE"
+            )
+            logging.info("Staged %d Parquet files", len(cs.fetchall()))
+
+    # 7.5 Load all staged chunks in one COPY; PURGE removes the files afterwards
+    with conn.cursor() as cs:
+        cs.execute("""
+            COPY INTO TRIPS
+            FROM @TRIPS_STG
+            FILE_FORMAT = (TYPE = PARQUET)
+            MATCH_BY_COLUMN_NAME = CASE_INSENSITIVE
+            PURGE = TRUE
+        """)
+        # one result row per file: (file, status, rows_parsed, rows_loaded, ...)
+        nrows = sum(row[3] for row in cs.fetchall() if len(row) > 3)
+        logging.info("COPY INTO TRIPS loaded %d rows", nrows)
 
-        # e) Clear the internal stage so files don’t accumulate between chunks
+    # 7.6 Rebuild the weekly summary served by GET /weekly_average?mode=region.
+    #     The rows are already committed, so a failure here must not fail the
+    #     ingest (a retry would load them twice); the summary is just stale.
+    try:
         with conn.cursor() as cs:
-            cs.execute("REMOVE @%TRIPS")  
-            logging.info("Stage TRIPS cleared")
+            refresh_weekly_summary(cs)
+    except Exception as e:
+        logging.warning("TRIPS_WEEKLY_BY_REGION not refreshed, summary is stale: %s", e)
 
-    # 4.4 Close the connection when done
+    # 7.7 Close the connection when done
     conn.close()
     logging.info("Pipeline completed successfully!")
 
 
 # ------------------------------------------------------------
-# 5. Entry point: argument parsing and main invocation
+# 8. Entry point: argument parsing and main invocation
 # ------------------------------------------------------------
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(